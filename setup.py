@@ -34,4 +34,7 @@ setup(
         'raven',
         'pika',
     ],
+    extras_require={
+        'hiredis': ['hiredis'],
+    },
 )
@@ -1,21 +1,30 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import re
 import sys
+import warnings
+import functools
 from tornado.util import import_object
-from trest.storage import SortedDict
-from trest.utils.func import safestr
 from trest.exception import ConfigError
 
 from .base import CacheMixin
 from .base import CacheClient
+from .base import CacheKeyWarning
 from .base import InvalidCacheBackendError
 from .base import DEFAULT_TIMEOUT
+from .base import default_key_func
 
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
 
+_dumps = pickle.dumps
+_loads = pickle.loads
+_PICKLE_PROTOCOL = pickle.HIGHEST_PROTOCOL
+# first byte of every pickle made with protocol 2 or higher (PROTO opcode)
+PICKLE_MARK = b'\x80'
+
 try:
     import redis
 except ImportError:
@@ -25,26 +34,33 @@ from redis.connection import Connection
 from redis.connection import DefaultParser
 from redis.connection import UnixDomainSocketConnection
 
+try:
+    from redis.connection import HiredisParser
+    from redis.utils import HIREDIS_AVAILABLE
+except ImportError:
+    HiredisParser = None
+    HIREDIS_AVAILABLE = False
 
-class CacheKey(object):
-    """
-    A stub string class that we can use to check if a key was created already.
-    """
 
-    def __init__(self, key):
-        self._key = key
+# INCRBY only if the key already exists, in a single round-trip
+INCR_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return nil
+end
+return redis.call('INCRBY', KEYS[1], ARGV[1])
+"""
 
-    def __eq__(self, other):
-        return self._key == other
 
-    def __str__(self):
-        return safestr(self._key)
+@functools.lru_cache(maxsize=4096, typed=True)
+def _build_key(key_func, key_prefix, key, version):
+    if key_func is default_key_func and _is_prefixed(key, key_prefix, version):
+        # already made by make_key, keep make_key idempotent
+        return key
+    return key_func(key, key_prefix, version)
 
-    def __repr__(self):
-        return repr(self._key)
 
-    def __hash__(self):
-        return hash(self._key)
+def _is_prefixed(key, key_prefix, version):
+    return isinstance(key, str) and key.startswith('%s:%s:' % (key_prefix, version))
 
 
 class CacheConnectionPool(object):
@@ -77,6 +93,42 @@ class CacheConnectionPool(object):
 
 pool = CacheConnectionPool()
 
+# (class, server, frozen params) => resolved connection pieces, reused when unpickling
+_CLIENT_CACHE = {}
+# attributes derived from (server, params) alone, safe to share between clients
+_CONNECTION_ATTRS = (
+    '_db', '_password', '_parser_class', '_connection_pool_class',
+    '_connection_pool_class_kwargs', '_client', '_incr_script',
+)
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _glob_escape(value):
+    """
+    Escapes the glob characters of a SCAN MATCH pattern.
+    """
+    return re.sub(r'([\\*?\[\]])', r'\\\1', str(value))
+
+
+def _freeze(obj):
+    if isinstance(obj, dict):
+        return frozenset((k, _freeze(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return tuple(_freeze(v) for v in obj)
+    if isinstance(obj, set):
+        return frozenset(obj)
+    return obj
+
 
 class RedisClient(CacheClient):
     def __init__(self, server, params):
@@ -89,6 +141,12 @@ class RedisClient(CacheClient):
         super(RedisClient, self).__init__(params)
         self._server = server
         self._params = params
+        # resolved once, these are read on every (re)connect
+        self._db = self._get_db()
+        self._password = self._get_password()
+        self._parser_class = self._get_parser_class()
+        self._connection_pool_class = self._get_connection_pool_class()
+        self._connection_pool_class_kwargs = self._get_connection_pool_class_kwargs()
 
         unix_socket_path = None
         if ':' in self.server:
@@ -117,6 +175,7 @@ class RedisClient(CacheClient):
             connection_pool=connection_pool,
             **kwargs
         )
+        self._incr_script = self._client.register_script(INCR_SCRIPT)
 
     @property
     def server(self):
@@ -136,6 +195,25 @@ class RedisClient(CacheClient):
 
     @property
     def connection_pool_class(self):
+        return self._connection_pool_class
+
+    @property
+    def connection_pool_class_kwargs(self):
+        return self._connection_pool_class_kwargs
+
+    @property
+    def db(self):
+        return self._db
+
+    @property
+    def password(self):
+        return self._password
+
+    @property
+    def parser_class(self):
+        return self._parser_class
+
+    def _get_connection_pool_class(self):
         cls = self.options.get('POOL_CLASS', 'redis.ConnectionPool')
         mod_path, cls_name = cls.rsplit('.', 1)
         try:
@@ -145,8 +223,7 @@ class RedisClient(CacheClient):
             raise ConfigError("Could not find connection pool class '%s'" % cls)
         return pool_class
 
-    @property
-    def connection_pool_class_kwargs(self):
+    def _get_connection_pool_class_kwargs(self):
         default = {
             'retry_on_timeout': False,
             'socket_keepalive': None,
@@ -158,8 +235,7 @@ class RedisClient(CacheClient):
         default.update(kw)
         return default
 
-    @property
-    def db(self):
+    def _get_db(self):
         _db = self.params.get('db', self.options.get('DB', 1))
         try:
             _db = int(_db)
@@ -167,15 +243,14 @@ class RedisClient(CacheClient):
             raise ConfigError("db value must be an integer")
         return _db
 
-    @property
-    def password(self):
+    def _get_password(self):
         return self.params.get('password', self.options.get('PASSWORD', None))
 
-    @property
-    def parser_class(self):
+    def _get_parser_class(self):
         cls = self.options.get('PARSER_CLASS', None)
         if cls is None:
-            return DefaultParser
+            # prefer the C parser whenever the hiredis package is installed
+            return HiredisParser if HIREDIS_AVAILABLE else DefaultParser
         mod_path, cls_name = cls.rsplit('.', 1)
         try:
             mod = import_object(mod_path)
@@ -188,12 +263,39 @@ class RedisClient(CacheClient):
         return {'params': self._params, 'server': self._server}
 
     def __setstate__(self, state):
-        self._init(**state)
+        server, params = state['server'], state['params']
+        try:
+            cache_key = (type(self), server, _freeze(params))
+            connection = _CLIENT_CACHE.get(cache_key)
+        except TypeError:
+            # unhashable params, can not be memoized
+            self._init(server, params)
+            return
+        if connection is None:
+            self._init(server, params)
+            _CLIENT_CACHE[cache_key] = dict(
+                (attr, getattr(self, attr)) for attr in _CONNECTION_ATTRS
+            )
+            return
+        # per-instance settings are always rebuilt from the pickled state
+        super(RedisClient, self).__init__(params)
+        self._server = server
+        self._params = params
+        self.__dict__.update(connection)
+        self._connection_pool_class_kwargs = dict(connection['_connection_pool_class_kwargs'])
 
     def make_key(self, key, version=None):
-        if not isinstance(key, CacheKey):
-            key = CacheKey(super(RedisClient, self).make_key(key, version))
-        return key
+        """
+        Keys already made for the same prefix and version are returned as is,
+        so passing a make_key() result back to get/set/delete is safe.
+        """
+        if version is None:
+            version = self.version
+        try:
+            return _build_key(self.key_func, self.key_prefix, key, version)
+        except TypeError:
+            # unhashable key, can not be memoized
+            return super(RedisClient, self).make_key(key, version)
 
     def ping(self):
         self.client.ping()
@@ -214,16 +316,20 @@ class RedisCache(CacheMixin, RedisClient):
         """
         if version is None:
             version = self.version
+        client = self._client
         old_key = self.make_key(key, version)
-        value = self.get(old_key, version=version)
-        ttl = self._client.ttl(old_key)
-        if value is None:
+        value = self.unpickle(client.get(old_key))
+        # TTL answers -2 for a missing key and -1 for a key without expiration
+        ttl = client.ttl(old_key)
+        if value is None or ttl == -2:
             raise ValueError("Key '%s' not found" % key)
+        if ttl == -1:
+            ttl = None
         new_key = self.make_key(key, version=version + delta)
         # TODO: See if we can check the version of Redis, since 2.2 will be able
         # to rename volitile keys.
-        self.set(new_key, value, timeout=ttl)
-        self.delete(old_key)
+        self._set(new_key, self._pickle_raw(value), ttl, client)
+        client.delete(old_key)
         return version + delta
 
     def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
@@ -274,11 +380,7 @@ class RedisCache(CacheMixin, RedisClient):
         if timeout is not None:
             timeout = int(timeout)
 
-        # If ``value`` is not an int, then pickle it
-        if not isinstance(value, int) or isinstance(value, bool):
-            result = self._set(key, pickle.dumps(value), timeout, client, _add_only)
-        else:
-            result = self._set(key, value, timeout, client, _add_only)
+        result = self._set(key, self._pickle_raw(value), timeout, client, _add_only)
         # result is a boolean
         return result
 
@@ -293,28 +395,56 @@ class RedisCache(CacheMixin, RedisClient):
         Remove multiple keys at once.
         """
         if keys:
-            keys = map(lambda key: self.make_key(key, version=version), keys)
-            self._client.delete(*keys)
+            make_key = self.make_key
+            self._client.delete(*[make_key(key, version=version) for key in keys])
 
     def clear(self):
         """
-        Flush all cache keys.
+        Remove the keys of this cache (current prefix and version) without
+        blocking redis with FLUSHDB, other keys in the db are left alone.
+
+        With a custom KEY_FUNCTION the keys can not be matched, the whole db
+        is flushed instead.
         """
-        # TODO : potential data loss here, should we only delete keys based on the correct version ?
-        self._client.flushdb()
+        client = self._client
+        if self.key_func is not default_key_func:
+            # there is no way to build a SCAN pattern from an arbitrary key function
+            warnings.warn('clear() with a custom KEY_FUNCTION flushes the whole redis db',
+                          CacheKeyWarning)
+            client.flushdb()
+            return
+        match = '%s:%s:*' % (_glob_escape(self.key_prefix), _glob_escape(self.version))
+        for batch in _chunks(client.scan_iter(match=match, count=1000), 500):
+            # UNLINK frees the memory in a background thread (redis >= 4.0)
+            client.execute_command('UNLINK', *batch)
 
     def unpickle(self, value):
         """
         Unpickles the given value.
         """
-        if value and not isinstance(value, int) or isinstance(value, bool):
-            return pickle.loads(value)
-        return value
+        t = type(value)
+        if t is int or not value:
+            return value
+        if t is bytes and value[:1] != PICKLE_MARK and value.lstrip(b'-').isdigit():
+            # ints are stored unpickled, redis hands them back as digits
+            return int(value)
+        return _loads(value)
+
+    def _pickle_raw(self, value):
+        """
+        Returns the value as it is stored in redis, ints are kept as is
+        so that ``incr`` keeps working, everything else is pickled.
+        """
+        if type(value) is int:
+            return value
+        return _dumps(value, _PICKLE_PROTOCOL)
 
     def pickle(self, value):
-
-        if value and not isinstance(value, int) or isinstance(value, bool):
-            return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        t = type(value)
+        if t is int:
+            return value
+        if t is bool or value:
+            return _dumps(value, _PICKLE_PROTOCOL)
         return value
 
     def get_many(self, keys, version=None):
@@ -323,17 +453,20 @@ class RedisCache(CacheMixin, RedisClient):
         """
         if not keys:
             return {}
-        recovered_data = SortedDict()
-        new_keys = list(map(lambda key: self.make_key(key, version=version), keys))
-        map_keys = dict(zip(new_keys, keys))
+        recovered_data = {}
+        make_key = self.make_key
+        unpickle = self.unpickle
+        new_keys = [make_key(key, version=version) for key in keys]
         results = self._client.mget(new_keys)
-        for key, value in zip(new_keys, results):
+        for key, value in zip(keys, results):
             if value is None:
                 continue
-            value = self.unpickle(value)
-            if isinstance(value, bytes):
-                value = safestr(value)
-            recovered_data[map_keys[key]] = value
+            # pickles are the common case, ints stored as digits take the slow path
+            if value[:1] == PICKLE_MARK:
+                value = _loads(value)
+            else:
+                value = unpickle(value)
+            recovered_data[key] = value
         return recovered_data
 
     def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
@@ -344,10 +477,26 @@ class RedisCache(CacheMixin, RedisClient):
         If timeout is given, that timeout will be used for the key; otherwise
         the default cache timeout will be used.
         """
-        pipeline = self._client.pipeline()
-        for key, value in data.items():
-            self.set(key, value, timeout, version=version, client=pipeline)
-        pipeline.execute()
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        if timeout is not None:
+            timeout = int(timeout)
+
+        make_key = self.make_key
+        pickle_raw = self._pickle_raw
+        keyed = [(make_key(key, version=version), pickle_raw(value))
+                 for key, value in data.items()]
+        if not keyed:
+            return
+        client = self._client
+        if timeout is None or timeout == 0:
+            client.mset(dict(keyed))
+        elif timeout > 0:
+            pipeline = client.pipeline(transaction=False)
+            setex = pipeline.setex
+            for key, value in keyed:
+                setex(key, timeout, value)
+            pipeline.execute()
 
     def incr(self, key, delta=1, version=None):
         """
@@ -355,14 +504,16 @@ class RedisCache(CacheMixin, RedisClient):
         ValueError exception.
         """
         key = self.make_key(key, version=version)
-        exists = self._client.exists(key)
-        if not exists:
-            raise ValueError("Key '%s' not found" % key)
         try:
-            value = self._client.incr(key, delta)
+            value = self._incr_script(keys=[key], args=[delta])
         except redis.ResponseError:
-            value = self.get(key) + delta
-            self.set(key, value)
+            # the stored value is pickled, not a redis integer
+            client = self._client
+            value = self.unpickle(client.get(key)) + delta
+            self._set(key, self._pickle_raw(value), self.default_timeout, client)
+            return value
+        if value is None:
+            raise ValueError("Key '%s' not found" % key)
         return value
 
     def ttl(self, key, version=None):
@@ -373,9 +524,13 @@ class RedisCache(CacheMixin, RedisClient):
         0 is returned.
         """
         key = self.make_key(key, version=version)
-        if self._client.exists(key):
-            return self._client.ttl(key)
-        return 0
+        # TTL answers -2 for a missing key and -1 for a key without expiration
+        ttl = self._client.ttl(key)
+        if ttl == -2:
+            return 0
+        if ttl == -1:
+            return None
+        return ttl
 
     def has_key(self, key, version=None):
         """
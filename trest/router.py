@@ -1,10 +1,10 @@
 #!/usr/bin/env python
 # -*- coding: utf-8  -*-
 import os
+import asyncio
+import threading
 import six
-import inspect
 import importlib
-import functools
 
 from tornado.util import import_object
 
@@ -15,21 +15,25 @@ from .utils.func import md5
 from .utils.encrypter import RSAEncrypter
 
 
+# app_name => handlers, handler discovery is static for the process lifetime
+_HANDLERS_CACHE = {}
+# 串行化首次加载，_create_handlers 会修改共享的 handler 类
+_HANDLERS_LOCK = threading.RLock()
+
 def _get_modules(package="."):
     """
     获取包名下所有非__init__的模块名
     """
     modules = []
-    files = os.listdir(package)
-    for file in files:
-        if file.startswith(('_', '.')):
-            continue
-        if not file.endswith('.py'):
-            continue
-        name, ext = os.path.splitext(file)
-        if name in ['common',]:
-            continue
-        modules.append('.' + name)
+    with os.scandir(package) as entries:
+        for entry in entries:
+            file = entry.name
+            if file.startswith(('_', '.')) or not file.endswith('.py'):
+                continue
+            name = file[:-3]
+            if name in ['common',]:
+                continue
+            modules.append('.' + name)
     return modules
 
 def _get_handler_params(module, attr):
@@ -43,7 +47,19 @@ def _get_handler_params(module, attr):
     if attr in ['Handler', 'CommonHandler']:
         return (False, False)
     handler = getattr(module, attr)
-    params = inspect.getmembers(handler, lambda f: callable(f) and hasattr(f, '_path'))
+    # 扫描各个类自己的 __dict__ ，跳过 Handler 及其基类，tornado 的基类里面不会有路由方法
+    names = set()
+    params = []
+    for klass in getattr(handler, '__mro__', ()):
+        if klass in Handler.__mro__:
+            continue
+        for name, val in vars(klass).items():
+            if name in names:
+                continue
+            names.add(name)
+            if callable(val) and getattr(val, '_path', None) is not None:
+                params.append((name, val))
+    params.sort(key=lambda item: item[0])
     if not params:
         return (False, False)
     return (handler, params)
@@ -124,8 +140,7 @@ def _create_handlers(app_name, handler, package, path_method_dict):
 
     return handlers
 
-def get_handlers(app_name):
-    """ 自动加载特定APP里面的handler """
+def _load_handlers(app_name):
     namespace = f'{settings.ROOT_PATH}/applications/{app_name}/handlers/'
     modules = _get_modules(namespace)
     # 将包下的所有模块，逐个导入，并调用其中的函数
@@ -144,93 +159,40 @@ def get_handlers(app_name):
             handlers += _create_handlers(app_name, handler, package, path_method_dict)
     return handlers
 
-def get(*dargs, **dkargs):
-    """
-    """
-    def wrapper(method):
-        path = dargs[0]
-        @functools.wraps(method)
-        def _wrapper(*args, **kargs):
-            return method(*args, **kargs)
-        _wrapper._path = path
-        _wrapper._method = 'get'
-        return _wrapper
-    return wrapper
-
-def head(*dargs, **dkargs):
-    """
-    """
-    def wrapper(method):
-        path = dargs[0]
-        @functools.wraps(method)
-        def _wrapper(*args, **kargs):
-            return method(*args, **kargs)
-        _wrapper._path = path
-        _wrapper._method = 'head'
-        return _wrapper
-    return wrapper
-
-def post(*dargs, **dkargs):
-    """
-    """
-    def wrapper(method):
-        path = dargs[0]
-        @functools.wraps(method)
-        def _wrapper(*args, **kargs):
-            return method(*args, **kargs)
-        _wrapper._path = path
-        _wrapper._method = 'post'
-        return _wrapper
-    return wrapper
-
-def delete(*dargs, **dkargs):
-    """
-    """
-    def wrapper(method):
-        path = dargs[0]
-        @functools.wraps(method)
-        def _wrapper(*args, **kargs):
-            return method(*args, **kargs)
-        _wrapper._path = path
-        _wrapper._method = 'delete'
-        return _wrapper
-    return wrapper
-
-def patch(*dargs, **dkargs):
-    """
-    """
-    def wrapper(method):
-        path = dargs[0]
-        @functools.wraps(method)
-        def _wrapper(*args, **kargs):
-            return method(*args, **kargs)
-        _wrapper._path = path
-        _wrapper._method = 'patch'
-        return _wrapper
-    return wrapper
-
-def put(*dargs, **dkargs):
+def get_handlers(app_name):
+    """ 自动加载特定APP里面的handler """
+    if app_name not in _HANDLERS_CACHE:
+        with _HANDLERS_LOCK:
+            if app_name not in _HANDLERS_CACHE:
+                _HANDLERS_CACHE[app_name] = _load_handlers(app_name)
+    return _HANDLERS_CACHE[app_name]
+
+async def async_get_handlers(app_name):
     """
+    get_handlers 的协程版本，在 event loop 里调用时把导入模块等阻塞操作放到线程池里执行
     """
-    def wrapper(method):
-        path = dargs[0]
-        @functools.wraps(method)
-        def _wrapper(*args, **kargs):
-            return method(*args, **kargs)
-        _wrapper._path = path
-        _wrapper._method = 'put'
-        return _wrapper
-    return wrapper
-
-def options(*dargs, **dkargs):
+    if app_name in _HANDLERS_CACHE:
+        return _HANDLERS_CACHE[app_name]
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, get_handlers, app_name)
+
+def _route(method):
     """
+    生成 method 对应的路由装饰器，直接在原函数上标记 _path/_method ，不再包一层函数
     """
-    def wrapper(method):
+    def decorator(*dargs, **dkargs):
         path = dargs[0]
-        @functools.wraps(method)
-        def _wrapper(*args, **kargs):
-            return method(*args, **kargs)
-        _wrapper._path = path
-        _wrapper._method = 'options'
-        return _wrapper
-    return wrapper
+        def wrapper(func):
+            func._path = path
+            func._method = method
+            return func
+        return wrapper
+    return decorator
+
+get = _route('get')
+head = _route('head')
+post = _route('post')
+delete = _route('delete')
+patch = _route('patch')
+put = _route('put')
+options = _route('options')